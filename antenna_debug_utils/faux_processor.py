@@ -35,32 +35,19 @@ It'll check the queue every second and pull stuff.
 import logging
 import logging.config
 import os
-import socket
 import sys
 import time
 
-import boto3
-from botocore.client import Config
-from botocore.exceptions import ClientError
 from everett.component import ConfigOptions, RequiredConfigMixin
-import pika
 
+from antenna_debug_utils.s3 import RETRY_MODES, get_client
 from antenna_debug_utils.util import run_program
 
-
-PIKA_EXCEPTIONS = (
-    pika.exceptions.AMQPConnectionError,
-    pika.exceptions.ChannelClosed,
-    pika.exceptions.ConnectionClosed,
-    pika.exceptions.NoFreeChannels,
-    socket.timeout
-)
-
 # These values match Antenna throttling return values
 ACCEPT = '0'
 DEFER = '1'
 
-logging.config.dictConfig({
+LOGGING_CONFIG = {
     'version': 1,
     'formatters': {
         'basic': {
@@ -84,13 +71,19 @@ logging.config.dictConfig({
         'handlers': ['console', 'file'],
         'level': 'DEBUG',
     },
-})
+}
 
 
 logger = logging.getLogger('processor')
 logger.setLevel(logging.DEBUG)
 
 
+def setup_logging():
+    # This creates faux_processor.log, so it only happens when the program
+    # runs
+    logging.config.dictConfig(LOGGING_CONFIG)
+
+
 def get_from_env(key):
     return os.environ['FAUX_%s' % key]
 
@@ -100,6 +93,8 @@ def get_throttle_result(crash_id):
 
 
 def build_pika_connection(host, port, virtual_host, user, password):
+    import pika
+
     return pika.BlockingConnection(
         pika.ConnectionParameters(
             host=host,
@@ -116,24 +111,32 @@ def build_pika_connection(host, port, virtual_host, user, password):
     )
 
 
+def parse_retry_mode(value):
+    if value not in RETRY_MODES:
+        raise ValueError('%r is not one of %s' % (value, ', '.join(RETRY_MODES)))
+    return value
+
+
 def get_conn(config):
     logger.info('S3_ACCESS_KEY: %s', config('s3_access_key'))
     logger.info('S3_SECRET_ACCESS_KEY: %s', '*****' if config('s3_secret_access_key') else '')
     logger.info('S3_REGION: %s', config('s3_region'))
     logger.info('S3_BUCKET: %s', config('s3_bucket'))
+    logger.info('S3_ENDPOINT_URL: %s', config('s3_endpoint_url'))
 
-    session_kwargs = {}
     if config('s3_access_key') and config('s3_secret_access_key'):
         logger.info('S3_ACCESS_KEY and S3_SECRET_ACCESS_KEY set--using those.')
-        session_kwargs['aws_access_key_id'] = config('s3_access_key')
-        session_kwargs['aws_secret_access_key'] = config('s3_secret_access_key')
-
-    session = boto3.session.Session(**session_kwargs)
 
-    return session.client(
-        service_name='s3',
-        region_name=config('s3_region'),
-        config=Config(s3={'addressing_style': 'path'})
+    return get_client(
+        region=config('s3_region'),
+        access_key=config('s3_access_key'),
+        secret_access_key=config('s3_secret_access_key'),
+        endpoint_url=config('s3_endpoint_url'),
+        max_pool_connections=config('s3_max_pool_connections'),
+        connect_timeout=config('s3_connect_timeout'),
+        read_timeout=config('s3_read_timeout'),
+        retry_mode=config('s3_retry_mode'),
+        max_attempts=config('s3_max_attempts'),
     )
 
 
@@ -150,6 +153,8 @@ def crashid_to_key(crashid):
 
 
 def check_for_crashes(channel, queue, conn, bucket):
+    from botocore.exceptions import ClientError
+
     while True:
         # Pull a crash id from the queue
         try:
@@ -227,11 +232,47 @@ class ProcessorProgram(RequiredConfigMixin):
         's3_bucket',
         doc='S3 bucket to check for crashes.'
     )
+    required_config.add_option(
+        's3_endpoint_url',
+        default='',
+        doc='S3 endpoint url to use instead of AWS, like a local S3 stand-in.'
+    )
+    required_config.add_option(
+        's3_max_pool_connections',
+        default='1',
+        parser=int,
+        doc='Size of the S3 connection pool. This checks one crash at a time.'
+    )
+    required_config.add_option(
+        's3_connect_timeout',
+        default='5',
+        parser=float,
+        doc='Seconds to wait for an S3 connection.'
+    )
+    required_config.add_option(
+        's3_read_timeout',
+        default='30',
+        parser=float,
+        doc='Seconds to wait for an S3 response.'
+    )
+    required_config.add_option(
+        's3_retry_mode',
+        default='standard',
+        parser=parse_retry_mode,
+        doc='botocore retry mode: %s.' % ', '.join(RETRY_MODES)
+    )
+    required_config.add_option(
+        's3_max_attempts',
+        default='3',
+        parser=int,
+        doc='Number of times botocore retries a failed S3 request.'
+    )
 
     def __init__(self, config):
         self.config = config.with_options(self)
 
     def invoke(self):
+        setup_logging()
         logger.info('FAUX-PROCESSOR STARTING UP...')
 
         rmq = build_pika_connection(
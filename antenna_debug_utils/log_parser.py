@@ -6,19 +6,30 @@
 
 This analyzes what happened in some period of time and spits out stats.
 
+With ``--verify``, crash ids that were received but not saved get checked
+against the S3 bucket while parsing is still going on. A received crash that
+hasn't been saved within ``--grace`` seconds of log time (or by the end of its
+file) gets handed off to a pool of concurrent S3 checkers right away. The
+report then splits "received but not saved" into crashes that are truly lost
+and crashes that are in S3, but are missing a "saved" log line.
+
 """
 
 import argparse
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import datetime
 import gzip
 import sys
+import time
 
 
 GZIP_HEADER = b'\037\213'
 
 CRASH_ID_LENGTH = 36
 
+# Number of lines to read between yields when checking unmatched crashes
+YIELD_INTERVAL = 1000
+
 RECEIVE = 'receive'
 SAVE = 'save'
 
@@ -84,12 +95,37 @@ def parse_line(line):
     return data
 
 
-def parse_files(start_date, end_date, filenames):
+def subtract_seconds(timestamp, seconds):
+    """Subtracts seconds from a log timestamp
+
+    :arg str timestamp: timestamp as "YYYY-mm-dd HH:MM:SS" with anything
+        after that ignored
+    :arg int seconds: seconds to subtract
+
+    :returns: str as "YYYY-mm-dd HH:MM:SS"
+
+    """
+    ts = datetime.datetime.strptime(timestamp[:19], '%Y-%m-%d %H:%M:%S')
+    return (ts - datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def parse_files(start_date, end_date, filenames, on_unmatched=None, grace=300):
     """Parses a file looking at records between bounded dates
 
+    If ``on_unmatched`` is given, it gets called with the ``CrashEvent`` for
+    every received crash that hasn't been saved ``grace`` seconds later in
+    log time or by the end of the file it's in. It might still get saved
+    later on, so callers have to reconcile against ``crashes_out`` at the end.
+
+    With ``on_unmatched``, this also calls ``time.sleep(0)`` every
+    ``YIELD_INTERVAL`` lines. When gevent has monkeypatched ``time``, that
+    lets greenlets kicked off by ``on_unmatched`` run while parsing goes on.
+
     :arg str start_date: the start date as "YYYY-mm-dd HH:MM:SS"
     :arg str end_date: the end date as "YYYY-mm-dd HH:MM:SS"
     :arg list filenames: the list of files to look at
+    :arg on_unmatched: function to call with unmatched receive events
+    :arg int grace: seconds to wait for a save before calling ``on_unmatched``
 
     :returns: ``(hostinfo_map, crashes_in, crashes_out)``
 
@@ -115,8 +151,16 @@ def parse_files(start_date, end_date, filenames):
         else:
             opener = open
 
+        # Map of crashid -> CrashEvent for receives waiting on a save in the
+        # order they were received
+        pending = OrderedDict()
+        last_timestamp = cutoff = None
+
         with opener(filename, 'r') as fp:
-            for line in fp:
+            for line_number, line in enumerate(fp):
+                if on_unmatched is not None and line_number % YIELD_INTERVAL == 0:
+                    time.sleep(0)
+
                 if not isinstance(line, str):
                     line = line.decode('utf-8')
 
@@ -138,6 +182,20 @@ def parse_files(start_date, end_date, filenames):
 
                 lines += 1
 
+                if on_unmatched is not None:
+                    # Only recompute the cutoff when the second changes
+                    if data.timestamp[:19] != last_timestamp:
+                        last_timestamp = data.timestamp[:19]
+                        cutoff = subtract_seconds(last_timestamp, grace)
+
+                    while pending:
+                        crash = next(iter(pending.values()))
+                        if crash.timestamp[:19] >= cutoff:
+                            break
+                        pending.popitem(last=False)
+                        if crash.crashid not in crashes_out:
+                            on_unmatched(crash)
+
                 if data.host not in hostinfo_map:
                     host, pid = data.host.split(' ')
                     hostinfo_map[data.host] = HostInfo(host, pid, start=data.timestamp)
@@ -149,12 +207,20 @@ def parse_files(start_date, end_date, filenames):
                 if data.action == RECEIVE and data.timestamp < end_date:
                     crashes_in[data.crashid] = data
                     hostinfo.crashes_in.append(data.crashid)
+                    if on_unmatched is not None:
+                        pending[data.crashid] = data
 
                 elif data.action == SAVE:
                     if data.timestamp < end_date or data.crashid in crashes_in:
                         crashes_out[data.crashid] = data
                         hostinfo.crashes_out.append(data.crashid)
 
+        # Anything still waiting at the end of the file gets checked now
+        if on_unmatched is not None:
+            for crash in pending.values():
+                if crash.crashid not in crashes_out:
+                    on_unmatched(crash)
+
     print('lines: %d' % lines)
     return hostinfo_map, crashes_in, crashes_out
 
@@ -175,6 +241,108 @@ def zero_fill(start_ts, end_ts):
     return slots
 
 
+class LostCrashVerifier:
+    """Checks crash ids against S3 in the background while parsing goes on
+
+    This uses the verify-crashids machinery, so it monkeypatches with gevent.
+    Greenlets only get to run when the parser yields, so ``submit`` yields
+    after every crash id it queues and ``parse_files`` yields every
+    ``YIELD_INTERVAL`` lines.
+
+    """
+    def __init__(self, bucket, region, access_key, secret_access_key, endpoint_url,
+                 concurrency):
+        from antenna_debug_utils import verify_crashids
+        verify_crashids.monkeypatch()
+
+        import gevent
+        from gevent.event import Event
+        from gevent.queue import Queue
+
+        self.gevent = gevent
+        self.verify_crashids = verify_crashids
+
+        conn = verify_crashids.get_conn(
+            region=region,
+            access_key=access_key,
+            secret_access_key=secret_access_key,
+            endpoint_url=endpoint_url,
+            max_pool_connections=concurrency,
+        )
+        controller = verify_crashids.AIMDController(
+            min_limit=min(10, concurrency),
+            max_limit=concurrency,
+        )
+        self.stats = verify_crashids.Stats()
+        verifier = verify_crashids.Verifier(
+            conn, bucket, controller, self.stats, max_retries=5
+        )
+
+        # Map of crashid -> (status, detail)
+        self.results = {}
+        self.submitted = set()
+
+        self.queue = Queue()
+        self.input_done = Event()
+        self.workers = [
+            gevent.spawn(
+                verify_crashids.worker, i, verifier, self.queue, self.input_done,
+                self.on_result
+            )
+            for i in range(concurrency)
+        ]
+
+    def on_result(self, crashid, status, detail):
+        self.results[crashid] = (status, detail)
+
+    def submit(self, crash):
+        if crash.crashid in self.submitted:
+            return
+        self.submitted.add(crash.crashid)
+        self.queue.put(crash.crashid)
+        self.gevent.sleep(0)
+
+    def finish(self):
+        """Waits for all the checks to finish
+
+        :returns: map of crashid -> ``(status, detail)``
+
+        """
+        self.input_done.set()
+        self.gevent.joinall(self.workers)
+        return self.results
+
+
+def print_verify_report(lost, results, verify_crashids):
+    """Prints S3 verification results for received but not saved crashes"""
+    by_status = {}
+    for crashid in lost:
+        status = results.get(crashid, ('unchecked', ''))[0]
+        by_status.setdefault(status, []).append(crashid)
+
+    in_s3 = by_status.get(verify_crashids.OK, [])
+    missing = by_status.get(verify_crashids.MISSING, [])
+    errors = by_status.get(verify_crashids.ERROR, []) + by_status.get('unchecked', [])
+
+    print('Received but not saved, verified against S3 (%d):' % len(lost))
+    print('   in S3, missing a "saved" log line: %d' % len(in_s3))
+    print('   not in S3--lost:                    %d' % len(missing))
+    print('   could not check:                    %d' % len(errors))
+    print()
+
+    print('Lost crashes (%d):' % len(missing))
+    for crashid in missing:
+        crash = lost[crashid]
+        print('   %s  %-70s  %s' % (crash.timestamp, crash.host, crash.crashid))
+    print()
+
+    if errors:
+        print('Could not check (%d):' % len(errors))
+        for crashid in errors:
+            print('   %s  %s' % (crashid, results.get(crashid, ('', 'never checked'))[1]))
+        print()
+
+
 def main(args):
     parser = argparse.ArgumentParser(
         description='Antenna log parser',
@@ -183,10 +351,53 @@ def main(args):
     parser.add_argument('start', help='start date/time--substring of YYYY-MM-DD HH:MM')
     parser.add_argument('end', help='end date/time--substring of YYYY-MM-DD HH:MM')
     parser.add_argument('filename', help='log files', nargs='*')
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='check received but not saved crashes against S3 while parsing'
+    )
+    parser.add_argument('--s3-bucket', help='S3 bucket to check for crashes')
+    parser.add_argument('--s3-region', default='us-west-1', help='S3 region of the S3 bucket')
+    parser.add_argument('--s3-access-key', default='', help='AWS S3 access_key if you need one')
+    parser.add_argument(
+        '--s3-secret-access-key', default='', help='AWS S3 secret_access_key if you need one'
+    )
+    parser.add_argument(
+        '--s3-endpoint-url', default='',
+        help='S3 endpoint url to use instead of AWS, like a local S3 stand-in'
+    )
+    parser.add_argument(
+        '--verify-concurrency', type=int, default=20,
+        help='maximum number of concurrent S3 requests'
+    )
+    parser.add_argument(
+        '--grace', type=int, default=300,
+        help='seconds of log time to wait for a "saved" line before checking S3'
+    )
 
-    args = parser.parse_args()
-
-    hostinfo_map, crashes_in, crashes_out = parse_files(args.start, args.end, args.filename)
+    args = parser.parse_args(args)
+
+    if args.verify and not args.s3_bucket:
+        parser.error('--verify requires --s3-bucket')
+
+    if args.verify_concurrency < 1:
+        parser.error('--verify-concurrency must be at least 1')
+
+    lost_verifier = None
+    on_unmatched = None
+    if args.verify:
+        lost_verifier = LostCrashVerifier(
+            bucket=args.s3_bucket,
+            region=args.s3_region,
+            access_key=args.s3_access_key,
+            secret_access_key=args.s3_secret_access_key,
+            endpoint_url=args.s3_endpoint_url,
+            concurrency=args.verify_concurrency,
+        )
+        on_unmatched = lost_verifier.submit
+
+    hostinfo_map, crashes_in, crashes_out = parse_files(
+        args.start, args.end, args.filename, on_unmatched=on_unmatched, grace=args.grace
+    )
 
     start_ts = None
     end_ts = None
@@ -269,6 +480,19 @@ def main(args):
             print('   %s: %s' % (slot, len(crashes)))
         print()
 
+    if lost_verifier is not None:
+        results = lost_verifier.finish()
+        lost = OrderedDict(
+            (crashid, crashes_in[crashid])
+            for crashid in sorted(in_set - out_set, key=lambda x: crashes_in[x].timestamp)
+        )
+        print_verify_report(lost, results, lost_verifier.verify_crashids)
+        print('S3 requests: %d  extra checks for crashes saved later: %d' % (
+            lost_verifier.stats.requests,
+            len(lost_verifier.submitted - set(lost)),
+        ))
+        print()
+
     buckets = {}
     print('Saved but not received (%d):' % len((out_set - in_set)))
     for crashid in sorted(out_set - in_set, key=lambda x: crashes_out[x].timestamp):
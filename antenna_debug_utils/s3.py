@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Shared S3 client setup for the tools
+
+boto3 clients are safe to share across threads and greenlets, but sessions
+and creating clients from them aren't. So clients get built under a lock and
+cached by their settings. Everything that asks for the same settings gets the
+same client and the same connection pool.
+
+boto3 gets imported the first time a client is built so that importing this
+module is cheap. The lock gets created then, too, so that it's a gevent lock
+when tools monkeypatch after importing this module.
+
+"""
+
+import threading
+
+
+RETRY_MODES = ('legacy', 'standard', 'adaptive')
+
+_CLIENTS = {}
+_LOCK = None
+
+# Guards creating _LOCK. It's only held for the assignment and never across a
+# yield, so it's fine for it to be a real OS lock under gevent.
+_LOCK_INIT = threading.Lock()
+
+
+def get_client(region, access_key='', secret_access_key='', endpoint_url='',
+               max_pool_connections=10, connect_timeout=5, read_timeout=30,
+               retry_mode='standard', max_attempts=None, tcp_keepalive=True):
+    """Returns a configured S3 client, reusing one if it's been built already
+
+    :arg str region: S3 region
+    :arg str access_key: AWS access key; if this or ``secret_access_key`` is
+        empty, boto3 figures out credentials on its own
+    :arg str secret_access_key: AWS secret access key
+    :arg str endpoint_url: S3 endpoint url to use instead of AWS--handy for
+        local S3 stand-ins
+    :arg int max_pool_connections: size of the connection pool; this should be
+        at least the number of concurrent requests
+    :arg float connect_timeout: seconds to wait for a connection
+    :arg float read_timeout: seconds to wait for a response
+    :arg str retry_mode: botocore retry mode; one of ``RETRY_MODES``
+    :arg int max_attempts: number of retries botocore does not counting the
+        first request; None for the botocore default
+    :arg bool tcp_keepalive: whether to turn on TCP keep-alive for pool
+        connections
+
+    :returns: boto3 S3 client
+
+    """
+    if retry_mode not in RETRY_MODES:
+        raise ValueError('retry_mode must be one of %s' % ', '.join(RETRY_MODES))
+
+    cache_key = (
+        region, access_key, secret_access_key, endpoint_url, max_pool_connections,
+        connect_timeout, read_timeout, retry_mode, max_attempts, tcp_keepalive
+    )
+
+    global _LOCK
+    if _LOCK is None:
+        with _LOCK_INIT:
+            if _LOCK is None:
+                _LOCK = threading.Lock()
+
+    with _LOCK:
+        client = _CLIENTS.get(cache_key)
+        if client is not None:
+            return client
+
+        import boto3
+        from botocore.client import Config
+
+        session_kwargs = {}
+        if access_key and secret_access_key:
+            session_kwargs['aws_access_key_id'] = access_key
+            session_kwargs['aws_secret_access_key'] = secret_access_key
+
+        session = boto3.session.Session(**session_kwargs)
+
+        retries = {'mode': retry_mode}
+        if max_attempts is not None:
+            retries['max_attempts'] = max_attempts
+
+        client = session.client(
+            service_name='s3',
+            region_name=region,
+            endpoint_url=endpoint_url or None,
+            config=Config(
+                s3={'addressing_style': 'path'},
+                max_pool_connections=max_pool_connections,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                retries=retries,
+                tcp_keepalive=tcp_keepalive,
+            )
+        )
+        _CLIENTS[cache_key] = client
+        return client
@@ -15,131 +15,1334 @@ Requires:
 
 Usage::
 
-    python3 verify_crashids.py [FILENAME]
+    verify-crashids --bucket BUCKET [--region REGION] [FILENAME ...]
 
 
-.. NOTE::
+Crash ids are read lazily from the files (plain or gzipped) or from stdin if
+there are none or the filename is ``-``. Blank lines and things that aren't
+crash ids are skipped and duplicates are dropped. Deduping uses a set of
+crash ids packed into 16 bytes each by default (21 to 43 bytes per crash id)
+or a Bloom filter with ``--dedupe=bloom`` which uses a fixed amount of memory
+(about 2 bytes per crash id at the default error rate), but may drop a small
+fraction of unique crash ids as false positives. For very large runs, use
+``--dedupe=bloom``.
 
-   You have to edit the script and fill in the BUCKET and REGION values.
+Crash ids go to the workers through a bounded queue so memory use stays flat
+and checking starts right away.
 
-   FIXME(willkg): We should change that to be params.
+With ``--strategy=list``, crash ids are read in batches of ``--batch-size``
+and grouped by their ``v2/raw_crash/{entropy}/{date}/`` prefix. Prefixes with
+at least ``--list-threshold`` crash ids get checked with paginated
+``list_objects_v2`` calls and a set difference. The rest get HEADed like
+usual. For bulk audits, that's a lot fewer requests.
 
-"""
+With ``--artifacts=all``, every artifact of a saved crash gets checked: the
+raw crash, the dump names and every dump listed in the dump names. The raw
+crash, dump names and the usual ``upload_file_minidump`` dump get checked
+concurrently. Any other dumps get checked concurrently once the dump names
+come back. A crash is only ok if every artifact is there.
+
+With ``--journal=PATH``, every verified crash id and every failure is
+appended to a local journal as it happens and the journal is flushed to disk
+every ``--checkpoint-interval`` seconds. If the run gets interrupted, run it
+again with ``--resume`` and crash ids already in the journal as ``ok`` or
+``missing`` are skipped. Crash ids that errored get tried again.
 
-from gevent import monkey; monkey.patch_all()  # noqa
+Concurrency is adaptive (AIMD). It starts at ``--min-concurrency`` workers
+and goes up by one each time a window of requests comes back healthy. It gets
+cut in half when S3 throttles us (``SlowDown``/503), when too many requests
+error out or when mean latency climbs to ``--latency-factor`` times the lowest
+it's been, which means requests are queueing up. ``--target-latency`` is a
+hard ceiling on mean latency. It never goes above ``--max-concurrency``.
+Throttled requests and requests that failed with a 5xx, a dropped connection
+or a timeout are retried with exponential backoff and jitter.
 
-from collections import deque
+"""
+
+import argparse
+from collections import namedtuple
+import gzip
+import hashlib
+import json
+import math
+import os
+from queue import Empty
+import random
+import re
 import sys
+import time
+
+from antenna_debug_utils.s3 import get_client
+
+
+GZIP_HEADER = b'\037\213'
+
+CRASH_ID_RE = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{6}[0-9]{6}$'
+)
+
+# Bytes in a line with a crash id and a newline
+CRASH_ID_LINE_LENGTH = 37
 
-import boto3
-from botocore.client import Config
-import gevent
+# Error codes S3 uses when it wants us to slow down
+THROTTLE_CODES = (
+    '503',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+    'SlowDown',
+    'Throttling',
+)
 
+MISSING_CODES = ('404', 'NoSuchKey', 'NotFound')
 
-BUCKET = ''
-REGION = ''
-ACCESS_KEY_ID = ''
-SECRET_ACCESS_KEY = ''
+# Backoff for retried requests in seconds
+BACKOFF_BASE = 0.1
+BACKOFF_CAP = 10.0
 
+# Verification statuses
+OK = 'ok'
+MISSING = 'missing'
+ERROR = 'error'
 
-def get_conn():
-    session = boto3.session.Session()
+# Statuses that mean we know the answer and don't need to check again
+FINAL_STATUSES = (OK, MISSING)
 
-    kwargs = {
-        'service_name': 's3',
-        'region_name': REGION,
-        'config': Config(s3={'addressing_style': 'path'})
-    }
+# Artifact names for --artifacts=all
+RAW_CRASH = 'raw_crash'
+DUMP_NAMES = 'dump_names'
+DEFAULT_DUMP_NAME = 'upload_file_minidump'
 
-    if ACCESS_KEY_ID and SECRET_ACCESS_KEY:
-        kwargs['aws_access_key_id'] = ACCESS_KEY_ID
-        kwargs['aws_secret_access_key'] = SECRET_ACCESS_KEY
 
-    return session.client(**kwargs)
+def monkeypatch():
+    """Monkeypatches with gevent
+
+    This has to happen before boto3 gets imported and any S3 clients get
+    built, so tools call it right before they start doing work.
+
+    """
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def get_conn(region, access_key, secret_access_key, max_pool_connections,
+             endpoint_url='', connect_timeout=5, read_timeout=30):
+    return get_client(
+        region=region,
+        access_key=access_key,
+        secret_access_key=secret_access_key,
+        endpoint_url=endpoint_url,
+        # One connection per in-flight request so workers don't wait on the
+        # pool
+        max_pool_connections=max_pool_connections,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        # We do our own retrying so the controller sees throttling
+        max_attempts=0,
+    )
 
 
 def get_date_from_crash_id(crash_id):
     return '20' + crash_id[-6:]
 
 
-def crashid_to_key(crashid):
-    return 'v2/raw_crash/{entropy}/{date}/{crash_id}'.format(
+def crashid_to_prefix(crashid):
+    return 'v2/raw_crash/{entropy}/{date}/'.format(
         entropy=crashid[:3],
         date=get_date_from_crash_id(crashid),
-        crash_id=crashid,
     )
 
 
-CRASHES = deque()
-RESULTS = []
-PER_SEC = 0
+def crashid_to_key(crashid):
+    return crashid_to_prefix(crashid) + crashid
+
+
+def crashid_to_dump_names_key(crashid):
+    return 'v1/dump_names/{crash_id}'.format(crash_id=crashid)
+
+
+def crashid_to_dump_key(crashid, dump_name):
+    # Antenna saves the upload_file_minidump dump as "dump"
+    if dump_name in (None, '', 'upload_file_minidump'):
+        dump_name = 'dump'
+    return 'v1/{dump_name}/{crash_id}'.format(dump_name=dump_name, crash_id=crashid)
+
+
+def is_crash_id(crashid):
+    return bool(CRASH_ID_RE.match(crashid))
+
+
+class PackedIdSet:
+    """Set of crash ids packed into 16 bytes each
+
+    Packed crash ids go in an open-addressing hash table in a single
+    ``bytearray``, so there's no per-id object overhead. The table is kept at
+    most 3/4 full, so this takes 21 to 43 bytes per crash id--roughly 1 to 2
+    GB for 50M crash ids--plus half that again briefly while it grows. For
+    bigger runs, use a ``BloomFilter``.
+
+    Growing rehashes the whole table, so pass a ``capacity`` when you know
+    roughly how many crash ids are coming. Growing yields with
+    ``time.sleep(0)`` every ``GROW_YIELD_INTERVAL`` slots so other greenlets
+    aren't stalled for the whole rehash. Only one greenlet should use a set
+    at a time.
+
+    :arg int capacity: number of crash ids to size the table for
+
+    """
+    EMPTY = bytes(16)
+
+    # Number of old slots to rehash between yields. gevent runs a batch of
+    # ready greenlets before it checks timers and sockets again, so this has
+    # to be small for in-flight requests to get a look in.
+    GROW_YIELD_INTERVAL = 256
+
+    def __init__(self, capacity=1 << 16):
+        self.num_slots = 1
+        while self.num_slots * 3 < capacity * 4:
+            self.num_slots *= 2
+        self.table = bytearray(16 * self.num_slots)
+        self.count = 0
+
+        # An all-zeros crash id looks like an empty slot, so it's tracked
+        # separately
+        self.has_empty = False
+
+    def __len__(self):
+        return self.count + int(self.has_empty)
+
+    def find(self, packed):
+        """Finds the slot for a packed crash id
+
+        :returns: ``(offset, found)`` where offset is where it is or where it
+            would go in the table
+
+        """
+        table = self.table
+        mask = self.num_slots - 1
+        slot = hash(packed) & mask
+
+        while True:
+            offset = slot * 16
+            current = table[offset:offset + 16]
+            if current == self.EMPTY:
+                return offset, False
+            if current == packed:
+                return offset, True
+            slot = (slot + 1) & mask
+
+    def insert(self, packed):
+        """Puts a packed crash id in the table
+
+        :returns: True if it wasn't in the table already
+
+        """
+        offset, found = self.find(packed)
+        if found:
+            return False
+        self.table[offset:offset + 16] = packed
+        return True
+
+    def grow(self):
+        old_table = self.table
+        self.num_slots *= 2
+        self.table = bytearray(16 * self.num_slots)
+        yield_bytes = 16 * self.GROW_YIELD_INTERVAL
+        for offset in range(0, len(old_table), 16):
+            if offset % yield_bytes == 0:
+                # This is gevent's sleep when monkeypatched
+                time.sleep(0)
+
+            packed = bytes(old_table[offset:offset + 16])
+            if packed != self.EMPTY:
+                self.insert(packed)
+
+    def __contains__(self, crashid):
+        packed = bytes.fromhex(crashid.replace('-', ''))
+        if packed == self.EMPTY:
+            return self.has_empty
+        return self.find(packed)[1]
+
+    def add(self, crashid):
+        """Adds a crash id
+
+        :returns: True if the crash id wasn't in the set already
+
+        """
+        packed = bytes.fromhex(crashid.replace('-', ''))
+        if packed == self.EMPTY:
+            if self.has_empty:
+                return False
+            self.has_empty = True
+            return True
+
+        if not self.insert(packed):
+            return False
+
+        self.count += 1
+        if self.count * 4 > self.num_slots * 3:
+            self.grow()
+        return True
+
+
+class BloomFilter:
+    """Bloom filter of crash ids
+
+    Memory use is fixed by ``capacity`` and ``error_rate``. Past ``capacity``
+    crash ids, the false positive rate goes up.
+
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, crashid):
+        """Adds a crash id
+
+        :returns: True if the crash id wasn't in the filter already
+
+        """
+        # Double hashing: two 64-bit halves of one digest give us all the
+        # bit positions
+        digest = hashlib.blake2b(crashid.encode('ascii'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        added = False
+        for i in range(self.num_hashes):
+            pos = (h1 + i * h2) % self.num_bits
+            byte, bit = pos >> 3, 1 << (pos & 7)
+            if not self.bits[byte] & bit:
+                self.bits[byte] |= bit
+                added = True
+        return added
+
+
+class NoDedupe:
+    def add(self, crashid):
+        return True
+
+
+def maybe_gunzip(fp):
+    if fp.peek(2)[:2] == GZIP_HEADER:
+        return gzip.GzipFile(fileobj=fp)
+    return fp
+
+
+def get_total_bytes(filenames):
+    """Returns the total size of the input files or None if it includes stdin
+
+    We can only estimate how much is left if we know the sizes of all the
+    files.
+
+    """
+    if not filenames or '-' in filenames:
+        return None
+    return sum(os.path.getsize(fn) for fn in filenames)
+
+
+class CrashIdReader:
+    """Lazily reads, validates and dedupes crash ids from files
+
+    :arg list filenames: the files to read from; ``-`` is stdin
+    :arg seen: object with an ``add(crashid)`` that returns False for crash ids
+        it has already seen
+    :arg finished: ``PackedIdSet`` of crash ids verified in an earlier run to
+        skip or None
+
+    """
+    def __init__(self, filenames, seen, finished=None):
+        self.filenames = filenames or ['-']
+        self.seen = seen
+        self.finished = finished
+
+        self.lines = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.already_verified = 0
+        self.crashids = 0
+
+        self.total_bytes = get_total_bytes(self.filenames)
+        self.finished_bytes = 0
+        self.current_fp = None
+
+    @property
+    def bytes_read(self):
+        current = self.current_fp.tell() if self.current_fp is not None else 0
+        return self.finished_bytes + current
+
+    def expected_total(self):
+        """Estimates how many crash ids the input will have in the end"""
+        bytes_read = self.bytes_read
+        if not self.total_bytes or not bytes_read:
+            return None
+        return int(self.crashids * self.total_bytes / bytes_read)
+
+    def iter_lines(self, filename):
+        """Lazily yields lines from a plain or gzipped file or stdin for ``-``"""
+        if filename == '-':
+            # Monkeypatching doesn't cover sys.stdin, so reading it directly
+            # would block every greenlet until there was more input
+            from gevent.fileobject import FileObject
+
+            yield from maybe_gunzip(FileObject(sys.stdin.fileno(), 'rb', close=False))
+            return
+
+        with open(filename, 'rb') as fp:
+            # For gzipped files, this is the position in the compressed file
+            self.current_fp = fp
+            yield from maybe_gunzip(fp)
+            self.current_fp = None
+        self.finished_bytes += os.path.getsize(filename)
+
+    def __iter__(self):
+        for filename in self.filenames:
+            for line in self.iter_lines(filename):
+                crashid = line.decode('utf-8', 'replace').strip().lower()
+                if not crashid:
+                    continue
+
+                self.lines += 1
+                if not is_crash_id(crashid):
+                    self.invalid += 1
+                    continue
+
+                if self.finished is not None and crashid in self.finished:
+                    self.already_verified += 1
+                    continue
+
+                if not self.seen.add(crashid):
+                    self.duplicates += 1
+                    continue
+
+                self.crashids += 1
+                yield crashid
+
+
+# A batch of crash ids sharing a prefix to check with a listing
+PrefixJob = namedtuple('PrefixJob', ['prefix', 'crashids'])
+
+
+def feed_queue(reader, queue, input_done):
+    try:
+        for crashid in reader:
+            queue.put(crashid)
+    finally:
+        input_done.set()
+
+
+def queue_batch(batch, queue, list_threshold):
+    """Groups a batch of crash ids by prefix and queues the jobs
+
+    Prefixes with at least ``list_threshold`` crash ids become a
+    ``PrefixJob``. The rest get queued one by one to be HEADed.
+
+    """
+    by_prefix = {}
+    for crashid in batch:
+        by_prefix.setdefault(crashid_to_prefix(crashid), []).append(crashid)
+
+    for prefix, crashids in by_prefix.items():
+        if len(crashids) >= list_threshold:
+            queue.put(PrefixJob(prefix, crashids))
+        else:
+            for crashid in crashids:
+                queue.put(crashid)
+
+
+def feed_queue_by_prefix(reader, queue, input_done, batch_size, list_threshold):
+    try:
+        batch = []
+        for crashid in reader:
+            batch.append(crashid)
+            if len(batch) >= batch_size:
+                queue_batch(batch, queue, list_threshold)
+                batch = []
+
+        queue_batch(batch, queue, list_threshold)
+    finally:
+        input_done.set()
+
+
+class ArtifactErrors(Exception):
+    """Errors from checking some of the artifacts of a crash
+
+    :arg errors: list of ``(artifact name, exception)``
+
+    """
+    def __init__(self, errors):
+        super().__init__('; '.join('%s: %s' % (name, exc) for name, exc in errors))
+        self.errors = errors
+
+
+def get_error_code(exc):
+    """Returns the (error code, http status) for a botocore ClientError
+
+    Anything that isn't a ClientError gets ``('', None)``.
+
+    """
+    response = getattr(exc, 'response', None) or {}
+    code = response.get('Error', {}).get('Code', '')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code, status
+
+
+def get_error_name(exc):
+    """Returns a name for the kind of error like ``ClientError:SlowDown``"""
+    if isinstance(exc, ArtifactErrors):
+        exc = exc.errors[0][1]
+    code = get_error_code(exc)[0]
+    name = type(exc).__name__
+    if code:
+        name = '%s:%s' % (name, code)
+    return name
+
+
+def is_throttle(exc):
+    code, status = get_error_code(exc)
+    return code in THROTTLE_CODES or status == 503
+
+
+def is_missing(exc):
+    code, status = get_error_code(exc)
+    return code in MISSING_CODES or status == 404
+
+
+def is_retryable(exc):
+    """Whether a request that failed with this is worth trying again"""
+    from botocore.exceptions import (
+        ConnectionClosedError,
+        EndpointConnectionError,
+        ReadTimeoutError,
+    )
+
+    if isinstance(exc, (ConnectionClosedError, EndpointConnectionError, ReadTimeoutError)):
+        return True
+
+    status = get_error_code(exc)[1]
+    return is_throttle(exc) or (status is not None and status >= 500)
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease concurrency limit
+
+    Every time ``limit`` requests have been recorded, the window is looked
+    at. If the error rate and mean latency are ok, the limit goes up by one.
+    Otherwise it gets multiplied by ``backoff``.
+
+    Mean latency is ok if it's under ``latency_factor`` times the baseline
+    and under ``target_latency``. The baseline is the lowest mean latency of
+    any healthy window. Once more concurrency only adds queueing, latency
+    climbs away from the baseline and the limit stops growing.
+
+    Throttling cuts the limit right away, but at most once per ``cooldown``
+    seconds so that a burst of throttled in-flight requests doesn't drop us
+    to the floor.
+
+    """
+    def __init__(self, min_limit, max_limit, target_latency=0.5, latency_factor=2.0,
+                 max_error_rate=0.05, backoff=0.5, cooldown=1.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.latency_factor = latency_factor
+        self.max_error_rate = max_error_rate
+        self.backoff = backoff
+        self.cooldown = cooldown
+
+        self.limit = float(min_limit)
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+        self.reset_window()
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+    def reset_window(self):
+        self.window_count = 0
+        self.window_errors = 0
+        self.window_latency = 0.0
+
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.reset_window()
+
+    def record(self, latency, error=False):
+        """Records a finished request
+
+        :arg float latency: how long the request took in seconds
+        :arg bool error: whether the request errored out
+
+        """
+        self.window_count += 1
+        self.window_latency += latency
+        if error:
+            self.window_errors += 1
+
+        if self.window_count < self.current:
+            return
+
+        mean_latency = self.window_latency / self.window_count
+        error_rate = self.window_errors / self.window_count
+        if error_rate > self.max_error_rate:
+            self.decrease()
+            self.reset_window()
+            return
+
+        if self.baseline_latency is None or mean_latency < self.baseline_latency:
+            self.baseline_latency = mean_latency
+
+        if (mean_latency > self.target_latency or
+                mean_latency > self.baseline_latency * self.latency_factor):
+            self.decrease()
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+        self.reset_window()
+
+    def throttled(self):
+        """Records a throttled request"""
+        self.decrease()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, index)]
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
 
+class Stats:
+    """Collects verification stats
 
-def worker(id_, conn):
-    global PER_SEC
+    Request latencies for the whole run are kept in a fixed-size reservoir
+    sample so percentiles don't need every latency in memory. Latencies for
+    the current interval are kept until the interval is reported.
 
-    total = successes = 0
-    failed = []
+    """
+    def __init__(self, reservoir_size=10000):
+        self.reservoir_size = reservoir_size
 
-    while CRASHES:
-        crashid = CRASHES.pop()
+        self.start_time = time.monotonic()
+        self.total = 0
+        self.by_status = {OK: 0, MISSING: 0, ERROR: 0}
+        self.errors_by_type = {}
+        self.missing_by_artifact = {}
 
-        total += 1
-        PER_SEC += 1
+        self.latencies = []
+        self.requests = 0
+        self.retries = 0
+        self.throttled_retries = 0
 
+        self.interval_start = self.start_time
+        self.interval_total = 0
+        self.interval_latencies = []
+
+    def record_request(self, latency):
+        """Records one S3 request
+
+        :arg float latency: how long the request took in seconds
+
+        """
+        self.requests += 1
+        self.interval_latencies.append(latency)
+        if len(self.latencies) < self.reservoir_size:
+            self.latencies.append(latency)
+        else:
+            index = random.randrange(self.requests)
+            if index < self.reservoir_size:
+                self.latencies[index] = latency
+
+    def record_retry(self, throttled):
+        self.retries += 1
+        if throttled:
+            self.throttled_retries += 1
+
+    def record_result(self, status, detail=None):
+        """Records the result for a crash id
+
+        :arg str status: one of ``OK``, ``MISSING`` or ``ERROR``
+        :arg detail: the exception for ``ERROR`` results
+
+        """
+        self.total += 1
+        self.interval_total += 1
+        self.by_status[status] += 1
+
+        if status == ERROR:
+            name = get_error_name(detail)
+            self.errors_by_type[name] = self.errors_by_type.get(name, 0) + 1
+
+    def record_missing_artifact(self, name):
+        self.missing_by_artifact[name] = self.missing_by_artifact.get(name, 0) + 1
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.total / elapsed if elapsed else 0.0
+
+    def eta(self, reader):
+        """Estimated seconds left or None if we can't tell"""
+        expected = reader.expected_total()
+        rate = self.rate()
+        if expected is None or not rate:
+            return None
+        return max(0, expected - self.total) / rate
+
+    def interval_line(self, reader, concurrency):
+        """Returns a progress line for the interval and starts a new one"""
+        now = time.monotonic()
+        elapsed = now - self.interval_start
+        rate = self.interval_total / elapsed if elapsed else 0.0
+        latencies = sorted(self.interval_latencies)
+        eta = self.eta(reader)
+
+        self.interval_start = now
+        self.interval_total = 0
+        self.interval_latencies = []
+
+        return (
+            '%d %d/s p50: %.0fms p90: %.0fms p99: %.0fms errors: %d concurrency: %d eta: %s' % (
+                self.total,
+                rate,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 90) * 1000,
+                percentile(latencies, 99) * 1000,
+                self.by_status[ERROR],
+                concurrency,
+                format_duration(eta) if eta is not None else '?',
+            )
+        )
+
+    def summary(self, reader, concurrency):
+        latencies = sorted(self.latencies)
+        return {
+            'elapsed_seconds': round(self.elapsed(), 3),
+            'input_lines': reader.lines,
+            'invalid': reader.invalid,
+            'duplicates': reader.duplicates,
+            'already_verified': reader.already_verified,
+            'total': self.total,
+            'ok': self.by_status[OK],
+            'missing': self.by_status[MISSING],
+            'error': self.by_status[ERROR],
+            'crashids_per_second': round(self.rate(), 3),
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled_retries': self.throttled_retries,
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'p90': round(percentile(latencies, 90) * 1000, 3),
+                'p99': round(percentile(latencies, 99) * 1000, 3),
+                'max': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            },
+            'errors_by_type': self.errors_by_type,
+            'missing_by_artifact': self.missing_by_artifact,
+            'final_concurrency': concurrency,
+        }
+
+
+class Verifier:
+    """Checks crash ids against an S3 bucket
+
+    :arg conn: boto3 S3 client
+    :arg str bucket: the bucket to check
+    :arg controller: ``AIMDController`` for deciding concurrency
+    :arg stats: ``Stats`` to record requests to
+    :arg int max_retries: number of times to retry throttled and failed
+        requests
+    :arg bool all_artifacts: whether to check all the artifacts of a crash
+        or just the raw crash
+
+    """
+    def __init__(self, conn, bucket, controller, stats, max_retries, all_artifacts=False):
+        self.conn = conn
+        self.bucket = bucket
+        self.controller = controller
+        self.stats = stats
+        self.max_retries = max_retries
+        self.all_artifacts = all_artifacts
+
+    def call(self, fun, **kwargs):
+        """Calls an S3 api function and records how it went
+
+        Throttled requests and requests that failed in a retryable way are
+        retried up to ``max_retries`` times with backoff. Missing keys count as
+        healthy requests as far as the controller is concerned.
+
+        :returns: whatever ``fun`` returns
+
+        :raises ClientError: if the key isn't there or S3 kept erroring
+
+        """
+        attempt = 0
+
+        while True:
+            start = time.monotonic()
+            try:
+                resp = fun(**kwargs)
+                latency = time.monotonic() - start
+                self.controller.record(latency)
+                self.stats.record_request(latency)
+                return resp
+
+            except Exception as exc:
+                latency = time.monotonic() - start
+                self.stats.record_request(latency)
+                if not is_retryable(exc) or attempt >= self.max_retries:
+                    self.controller.record(latency, error=not is_missing(exc))
+                    raise
+
+                throttled = is_throttle(exc)
+                self.stats.record_retry(throttled)
+                if throttled:
+                    self.controller.throttled()
+                else:
+                    self.controller.record(latency, error=True)
+
+            # This is gevent's sleep when monkeypatched, so it's fine in
+            # greenlets and threads both
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def head_crash(self, crashid):
+        """HEADs the raw crash for a crash id
+
+        :raises ClientError: if the crash isn't there or S3 kept erroring
+
+        """
+        self.call(
+            self.conn.head_object,
+            Bucket=self.bucket,
+            Key=crashid_to_key(crashid),
+        )
+
+    def list_prefix(self, prefix, start_after, stop_at):
+        """Lists keys under a prefix between ``start_after`` and ``stop_at``
+
+        :returns: set of keys
+
+        """
+        keys = set()
+        kwargs = {
+            'Bucket': self.bucket,
+            'Prefix': prefix,
+            'StartAfter': start_after,
+        }
+
+        while True:
+            resp = self.call(self.conn.list_objects_v2, **kwargs)
+            contents = resp.get('Contents', [])
+            keys.update(item['Key'] for item in contents)
+
+            # Keys come back sorted, so once we've passed the last one we
+            # care about, we're done
+            if not resp.get('IsTruncated') or (contents and contents[-1]['Key'] >= stop_at):
+                return keys
+
+            kwargs['ContinuationToken'] = resp['NextContinuationToken']
+
+    def check_key(self, key):
+        """HEADs a key
+
+        :returns: ``(status, detail)``
+
+        """
         try:
-            key = crashid_to_key(crashid)
-            conn.head_object(
-                Bucket=BUCKET,
-                Key=key,
+            self.call(self.conn.head_object, Bucket=self.bucket, Key=key)
+            return OK, ''
+        except Exception as exc:
+            return MISSING if is_missing(exc) else ERROR, exc
+
+    def fetch_dump_names(self, crashid):
+        """Fetches the list of dump names for a crash
+
+        :returns: ``(status, detail, dump_names)``
+
+        """
+        try:
+            resp = self.call(
+                self.conn.get_object,
+                Bucket=self.bucket,
+                Key=crashid_to_dump_names_key(crashid),
             )
-            successes += 1
+            return OK, '', json.loads(resp['Body'].read().decode('utf-8'))
+        except Exception as exc:
+            return MISSING if is_missing(exc) else ERROR, exc, []
+
+    def verify_crash(self, crashid):
+        """Verifies a single crash id
+
+        This HEADs the raw crash or, if ``all_artifacts`` is set, checks all
+        the artifacts.
+
+        :returns: list of ``(crashid, status, detail)``
+
+        """
+        if self.all_artifacts:
+            return self.verify_artifacts(crashid)
+
+        try:
+            self.head_crash(crashid)
+            return [(crashid, OK, '')]
         except Exception as exc:
-            print('FAIL: %s %s' % (crashid, exc))
-            failed.append((crashid, exc))
+            return [(crashid, MISSING if is_missing(exc) else ERROR, exc)]
+
+    def verify_artifacts(self, crashid):
+        """Verifies all the artifacts for a crash id
+
+        The raw crash, dump names and the default dump are checked
+        concurrently. Other dumps in the dump names are checked concurrently
+        after that. The crash is missing if any artifact is missing and an
+        error if any check errored.
+
+        :returns: list of ``(crashid, status, detail)``
+
+        """
+        import gevent
+
+        raw = gevent.spawn(self.check_key, crashid_to_key(crashid))
+        names = gevent.spawn(self.fetch_dump_names, crashid)
+        default_dump = gevent.spawn(
+            self.check_key, crashid_to_dump_key(crashid, DEFAULT_DUMP_NAME)
+        )
+        gevent.joinall([raw, names, default_dump])
+
+        names_status, names_detail, dump_names = names.value
+        checks = {
+            RAW_CRASH: raw.value,
+            DUMP_NAMES: (names_status, names_detail),
+        }
 
-    RESULTS.append((total, successes, failed))
+        # If we don't know the dump names, the default dump is the best guess
+        if names_status != OK or DEFAULT_DUMP_NAME in dump_names:
+            checks[DEFAULT_DUMP_NAME] = default_dump.value
+
+        other_dumps = [
+            (name, gevent.spawn(self.check_key, crashid_to_dump_key(crashid, name)))
+            for name in dump_names
+            if name != DEFAULT_DUMP_NAME
+        ]
+        gevent.joinall([greenlet for name, greenlet in other_dumps])
+        for name, greenlet in other_dumps:
+            checks[name] = greenlet.value
+
+        missing = []
+        errors = []
+        for name, (status, detail) in sorted(checks.items()):
+            if status == MISSING:
+                missing.append(name)
+                self.stats.record_missing_artifact(name)
+            elif status == ERROR:
+                errors.append((name, detail))
+
+        if errors:
+            return [(crashid, ERROR, ArtifactErrors(errors))]
+        if missing:
+            return [(crashid, MISSING, 'missing: %s' % ', '.join(missing))]
+        return [(crashid, OK, '')]
+
+    def verify_prefix(self, job):
+        """Verifies a batch of crash ids sharing a prefix with a listing
+
+        :returns: list of ``(crashid, status, detail)``
+
+        """
+        crashids = sorted(job.crashids)
+
+        # StartAfter is exclusive, so start after the first key minus its
+        # last character which sorts right before it
+        start_after = job.prefix + crashids[0][:-1]
+        stop_at = job.prefix + crashids[-1]
+
+        try:
+            keys = self.list_prefix(job.prefix, start_after, stop_at)
+        except Exception as exc:
+            return [(crashid, ERROR, exc) for crashid in crashids]
+
+        return [
+            (crashid, OK, '') if job.prefix + crashid in keys
+            else (crashid, MISSING, 'not in listing')
+            for crashid in crashids
+        ]
+
+
+class Journal:
+    """Append-only journal of verified crash ids
+
+    Each line is ``STATUS CRASHID [DETAIL]``. Lines get flushed and fsynced at
+    most every ``checkpoint_interval`` seconds, so an interruption loses at most
+    that much work.
+
+    """
+    def __init__(self, path, checkpoint_interval=5.0):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+
+        # If the last run was interrupted mid-write, finish off the partial
+        # line so the next entry doesn't get glued to it
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                needs_newline = fp.read(1) != b'\n'
+
+        self.fp = open(path, 'a')
+        if needs_newline:
+            self.fp.write('\n')
+        self.last_checkpoint = time.monotonic()
+
+    def write(self, status, crashid, detail=''):
+        # Keep each entry on one line no matter what the exception said
+        detail = ' '.join(str(detail).split())
+        self.fp.write(('%s %s %s' % (status, crashid, detail)).rstrip() + '\n')
+
+    def checkpoint(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.last_checkpoint = time.monotonic()
+
+    def maybe_checkpoint(self):
+        if time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def close(self):
+        self.checkpoint()
+        self.fp.close()
+
+
+def load_journal(path):
+    """Loads crash ids with a final status in the journal
+
+    Partial lines from an interrupted write are ignored.
+
+    :returns: ``PackedIdSet`` of crash ids
+
+    """
+    finished = PackedIdSet()
+    with open(path, 'r') as fp:
+        for line in fp:
+            parts = line.split(' ', 2)
+            if len(parts) < 2 or parts[0] not in FINAL_STATUSES:
+                continue
+
+            crashid = parts[1].strip()
+            if is_crash_id(crashid):
+                finished.add(crashid)
+    return finished
+
+
+def worker(id_, verifier, queue, input_done, on_result):
+    """Pulls crash ids and prefix jobs off the queue and verifies them
+
+    Runs until the input is done and the queue is empty. ``on_result`` gets
+    called with ``(crashid, status, detail)`` for every crash id.
+
+    """
+    controller = verifier.controller
+
+    while True:
+        # Workers above the current limit idle until the controller lets them
+        # in
+        if id_ >= controller.current:
+            if input_done.is_set() and queue.empty():
+                return
+            time.sleep(0.1)
+            continue
+
+        try:
+            item = queue.get(timeout=0.5)
+        except Empty:
+            if input_done.is_set():
+                return
+            continue
+
+        if isinstance(item, PrefixJob):
+            results = verifier.verify_prefix(item)
+        else:
+            results = verifier.verify_crash(item)
+
+        for crashid, status, detail in results:
+            verifier.stats.record_result(status, detail)
+            on_result(crashid, status, detail)
 
 
 def main(args):
-    global PER_SEC
+    parser = argparse.ArgumentParser(
+        prog='verify-crashids',
+        description='Verifies crash ids exist in an S3 bucket',
+    )
+    parser.add_argument('--bucket', required=True, help='S3 bucket to check for crashes.')
+    parser.add_argument('--region', default='us-west-1', help='S3 region of the S3 bucket.')
+    parser.add_argument('--access-key', default='', help='AWS S3 access_key if you need one.')
+    parser.add_argument(
+        '--secret-access-key', default='',
+        help='AWS S3 secret_access_key if you need one.'
+    )
+    parser.add_argument(
+        '--endpoint-url', default='',
+        help='S3 endpoint url to use instead of AWS, like a local S3 stand-in.'
+    )
+    parser.add_argument(
+        '--connect-timeout', type=float, default=5.0,
+        help='Seconds to wait for an S3 connection. Default is 5.'
+    )
+    parser.add_argument(
+        '--read-timeout', type=float, default=30.0,
+        help='Seconds to wait for an S3 response. Default is 30.'
+    )
+    parser.add_argument(
+        '--min-concurrency', type=int, default=10,
+        help='Starting and minimum number of concurrent requests. Default is 10.'
+    )
+    parser.add_argument(
+        '--max-concurrency', type=int, default=100,
+        help='Maximum number of concurrent requests. Default is 100.'
+    )
+    parser.add_argument(
+        '--target-latency', type=float, default=0.5,
+        help=(
+            'Mean request latency in seconds above which concurrency is always cut '
+            'back. Default is 0.5.'
+        )
+    )
+    parser.add_argument(
+        '--latency-factor', type=float, default=2.0,
+        help=(
+            'Cut concurrency back when mean request latency goes over this many '
+            'times the lowest it has been. Default is 2.0.'
+        )
+    )
+    parser.add_argument(
+        '--max-retries', type=int, default=5,
+        help='Number of times to retry a throttled or failed request. Default is 5.'
+    )
+    parser.add_argument(
+        '--dedupe', choices=['packed', 'bloom', 'none'], default='packed',
+        help=(
+            'How to drop duplicate crash ids: a set of packed ids, a Bloom filter '
+            'or not at all. Default is packed.'
+        )
+    )
+    parser.add_argument(
+        '--bloom-capacity', type=int, default=50000000,
+        help='Number of crash ids to size the Bloom filter for. Default is 50000000.'
+    )
+    parser.add_argument(
+        '--bloom-error-rate', type=float, default=0.001,
+        help='False positive rate for the Bloom filter. Default is 0.001.'
+    )
+    parser.add_argument(
+        '--queue-size', type=int, default=10000,
+        help='Number of crash ids to buffer ahead of the workers. Default is 10000.'
+    )
+    parser.add_argument(
+        '--strategy', choices=['head', 'list'], default='head',
+        help=(
+            'head checks every crash id with a HEAD. list groups crash ids by prefix '
+            'and lists prefixes that have enough of them. Default is head.'
+        )
+    )
+    parser.add_argument(
+        '--list-threshold', type=int, default=3,
+        help=(
+            'With --strategy=list, prefixes with at least this many crash ids get '
+            'listed; the rest get HEADed. Default is 3.'
+        )
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=100000,
+        help='With --strategy=list, number of crash ids to group at a time. Default is 100000.'
+    )
+    parser.add_argument(
+        '--artifacts', choices=['raw', 'all'], default='raw',
+        help=(
+            'raw checks only the raw crash. all checks the raw crash, dump names and '
+            'dumps. Default is raw.'
+        )
+    )
+    parser.add_argument(
+        '--journal',
+        help='Append-only file to record verified crash ids and failures to as they happen.'
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Skip crash ids already verified in --journal from an earlier run.'
+    )
+    parser.add_argument(
+        '--checkpoint-interval', type=float, default=5.0,
+        help='Seconds between flushing the journal to disk. Default is 5.'
+    )
+    parser.add_argument(
+        '--progress-interval', type=float, default=1.0,
+        help='Seconds between progress lines. Default is 1.'
+    )
+    parser.add_argument(
+        '--summary-file',
+        help='File to write a JSON summary of the run to at the end.'
+    )
+    parser.add_argument(
+        'filename', nargs='*',
+        help='files of crash ids--one per line--plain or gzipped; - or nothing for stdin'
+    )
+
+    args = parser.parse_args(args)
+
+    if args.min_concurrency < 1 or args.max_concurrency < args.min_concurrency:
+        parser.error('need 1 <= --min-concurrency <= --max-concurrency')
+
+    if args.latency_factor <= 1:
+        parser.error('--latency-factor must be greater than 1')
+
+    for filename in args.filename:
+        if filename != '-' and not os.path.exists(filename):
+            parser.error('file %s does not exist' % filename)
+
+    if args.artifacts == 'all' and args.strategy == 'list':
+        parser.error('--artifacts=all requires --strategy=head')
+
+    if args.resume and not args.journal:
+        parser.error('--resume requires --journal')
+
+    if args.journal and os.path.exists(args.journal) and not args.resume:
+        parser.error('journal %s exists--pass --resume or remove it' % args.journal)
+
+    monkeypatch()
+    import gevent
+    from gevent.event import Event
+    from gevent.queue import Queue
+
+    conn = get_conn(
+        region=args.region,
+        access_key=args.access_key,
+        secret_access_key=args.secret_access_key,
+        endpoint_url=args.endpoint_url,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        # With all artifacts, each worker has up to 3 requests in flight
+        max_pool_connections=args.max_concurrency * (3 if args.artifacts == 'all' else 1),
+    )
+    controller = AIMDController(
+        min_limit=args.min_concurrency,
+        max_limit=args.max_concurrency,
+        target_latency=args.target_latency,
+        latency_factor=args.latency_factor,
+    )
+
+    if args.dedupe == 'bloom':
+        seen = BloomFilter(args.bloom_capacity, args.bloom_error_rate)
+    elif args.dedupe == 'packed':
+        # Size the table for the input up front so it doesn't have to grow
+        # in the middle of the run
+        total_bytes = get_total_bytes(args.filename)
+        if total_bytes:
+            seen = PackedIdSet(max(1 << 16, total_bytes // CRASH_ID_LINE_LENGTH))
+        else:
+            seen = PackedIdSet()
+    else:
+        seen = NoDedupe()
+
+    journal = None
+    finished = None
+    if args.journal:
+        if args.resume and os.path.exists(args.journal):
+            finished = load_journal(args.journal)
+            print('Resuming: %d crash ids already verified' % len(finished))
+        journal = Journal(args.journal, args.checkpoint_interval)
+
+    stats = Stats()
+    verifier = Verifier(
+        conn, args.bucket, controller, stats, args.max_retries,
+        all_artifacts=(args.artifacts == 'all'),
+    )
 
-    fn = args[0]
+    reader = CrashIdReader(args.filename, seen, finished)
+    queue = Queue(maxsize=args.queue_size)
+    input_done = Event()
+    if args.strategy == 'list':
+        feeder = gevent.spawn(
+            feed_queue_by_prefix, reader, queue, input_done, args.batch_size,
+            args.list_threshold
+        )
+    else:
+        feeder = gevent.spawn(feed_queue, reader, queue, input_done)
 
-    conn = get_conn()
+    def on_result(crashid, status, detail):
+        if status != OK:
+            print('FAIL: %s %s' % (crashid, detail))
 
-    with open(fn, 'r') as fp:
-        for crashid in fp:
-            CRASHES.append(crashid.strip())
+        if journal is not None:
+            journal.write(status, crashid, detail)
 
-    workers = [gevent.spawn(worker, i, conn) for i in range(10)]
-    total = 0
+    workers = [
+        gevent.spawn(worker, i, verifier, queue, input_done, on_result)
+        for i in range(args.max_concurrency)
+    ]
 
-    while CRASHES:
-        total += PER_SEC
-        print('%d %d/s' % (total, PER_SEC))
-        PER_SEC = 0
-        gevent.sleep(1)
+    while True:
+        gevent.joinall(workers, timeout=args.progress_interval)
+        print(stats.interval_line(reader, controller.current))
+        if journal is not None:
+            journal.maybe_checkpoint()
+        if all(w.dead for w in workers):
+            break
 
-    gevent.sleep(5)
+    if journal is not None:
+        journal.close()
 
-    total = successes = 0
-    failed = []
+    summary = stats.summary(reader, controller.current)
+    if args.summary_file:
+        with open(args.summary_file, 'w') as fp:
+            json.dump(summary, fp, indent=2, sort_keys=True)
 
-    for res in RESULTS:
-        total += res[0]
-        successes += res[1]
-        failed.extend(res[2])
+    print('Input lines: %d' % reader.lines)
+    print('  Invalid:    %d' % reader.invalid)
+    print('  Duplicates: %d' % reader.duplicates)
+    print('  Already verified: %d' % reader.already_verified)
+    print('Total crash ids: %d' % stats.total)
+    print('  Success: %d' % stats.by_status[OK])
+    print('  Missing: %d' % stats.by_status[MISSING])
+    print('  Errors:  %d' % stats.by_status[ERROR])
+    for name, count in sorted(stats.errors_by_type.items()):
+        print('    %s: %d' % (name, count))
+    print('Requests: %d' % stats.requests)
+    print('  Retried: %d (throttled: %d)' % (stats.retries, stats.throttled_retries))
+    if verifier.all_artifacts:
+        print('Missing by artifact:')
+        for name, count in sorted(stats.missing_by_artifact.items()):
+            print('  %s: %d' % (name, count))
+    print('Elapsed: %s (%.1f/s)' % (format_duration(stats.elapsed()), stats.rate()))
+    print('Latency: p50 %.0fms  p90 %.0fms  p99 %.0fms' % (
+        summary['latency_ms']['p50'],
+        summary['latency_ms']['p90'],
+        summary['latency_ms']['p99'],
+    ))
+    if journal is not None:
+        print('Failures are in the journal: %s' % journal.path)
 
-    print('Total lines: %d' % total)
-    print('  Success: %d' % successes)
-    print('  Fails:   %d' % len(failed))
-    for fail in failed:
-        print(fail)
+    if feeder.exception is not None:
+        print('Reading crash ids failed: %s' % feeder.exception)
+        return 1
 
 
 def cli_main():
-    # FIXME(willkg): Fix argument parsing here
     sys.exit(main(sys.argv[1:]))
 
 
@@ -0,0 +1,237 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""In-process stand-ins for RabbitMQ and S3
+
+``FakeChannel`` implements the bits of the pika channel api the tools use.
+
+``FakeS3Server`` is a tiny S3 endpoint running on a gevent WSGI server in
+the same process. Point a real boto3 client at ``endpoint_url`` and it
+handles HEAD and GET object and ListObjectsV2 with configurable latency,
+jitter, error rate and throttle rate. Since the real client talks to it over
+HTTP, benchmarks include botocore and connection pool overhead.
+
+Both need gevent monkeypatching to have happened already.
+
+"""
+
+import bisect
+from collections import deque, namedtuple
+import random
+import time
+from urllib.parse import parse_qs, unquote
+from xml.sax.saxutils import escape
+
+
+Method = namedtuple('Method', ['delivery_tag'])
+
+
+class FakeChannel:
+    """Stand-in for a pika ``BlockingChannel`` with one queue of messages
+
+    :arg messages: iterable of message bodies as bytes
+    :arg float latency: seconds each ``basic_get`` takes
+
+    """
+    def __init__(self, messages, latency=0.0):
+        self.messages = deque(messages)
+        self.latency = latency
+
+        self.delivery_tag = 0
+        self.unacked = {}
+        self.acked = 0
+        self.get_times = []
+        self.consumers = []
+
+    def basic_get(self, queue, auto_ack=False):
+        if self.latency:
+            time.sleep(self.latency)
+        self.get_times.append(time.perf_counter())
+
+        if not self.messages:
+            return None, None, None
+
+        self.delivery_tag += 1
+        body = self.messages.popleft()
+        if not auto_ack:
+            self.unacked[self.delivery_tag] = body
+        return Method(self.delivery_tag), {}, body
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+
+        for tag in tags:
+            del self.unacked[tag]
+            self.acked += 1
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.consumers.append((on_message_callback, auto_ack))
+        return 'ctag%d' % len(self.consumers)
+
+    def start_consuming(self):
+        """Delivers messages to consumers until the queue is empty"""
+        while self.messages and self.consumers:
+            for callback, auto_ack in self.consumers:
+                method, properties, body = self.basic_get('', auto_ack=auto_ack)
+                if method is None:
+                    return
+                callback(self, method, properties, body)
+
+
+ERROR_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Error><Code>{code}</Code><Message>{message}</Message></Error>'
+)
+
+LIST_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+    '<Name>{bucket}</Name><Prefix>{prefix}</Prefix><KeyCount>{count}</KeyCount>'
+    '<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{truncated}</IsTruncated>'
+    '{contents}{token}'
+    '</ListBucketResult>'
+)
+
+CONTENTS_XML = (
+    '<Contents><Key>{key}</Key><LastModified>2017-03-20T00:00:00.000Z</LastModified>'
+    '<ETag>&quot;0&quot;</ETag><Size>{size}</Size><StorageClass>STANDARD</StorageClass>'
+    '</Contents>'
+)
+
+
+class FakeS3Server:
+    """In-process S3 endpoint for one bucket
+
+    :arg dict objects: map of key -> body bytes
+    :arg float latency: seconds every request takes
+    :arg float jitter: up to this many extra seconds, picked at random
+    :arg float error_rate: fraction of requests that get a 500
+    :arg float throttle_rate: fraction of requests that get a 503 SlowDown
+
+    """
+    def __init__(self, objects=None, latency=0.0, jitter=0.0, error_rate=0.0,
+                 throttle_rate=0.0):
+        self.objects = dict(objects or {})
+        self.sorted_keys = sorted(self.objects)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+
+        self.requests = {}
+        self.server = None
+
+    def add(self, key, body=b''):
+        if key not in self.objects:
+            bisect.insort(self.sorted_keys, key)
+        self.objects[key] = body
+
+    def count(self, operation):
+        self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def start(self):
+        from gevent.pywsgi import WSGIServer
+
+        self.server = WSGIServer(('127.0.0.1', 0), self.app, log=None, error_log=None)
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+
+    @property
+    def endpoint_url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def respond(self, start_response, status, body=b'', headers=None):
+        headers = list(headers or [])
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body]
+
+    def error(self, start_response, status, code, method):
+        if method == 'HEAD':
+            # HEAD responses have no body; botocore goes by the status
+            return self.respond(start_response, status)
+        body = ERROR_XML.format(code=code, message=code).encode('utf-8')
+        return self.respond(
+            start_response, status, body, [('Content-Type', 'application/xml')]
+        )
+
+    def app(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = unquote(environ['PATH_INFO']).lstrip('/')
+        bucket, _, key = path.partition('/')
+        query = parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True)
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if 'list-type' in query:
+            operation = 'ListObjectsV2'
+        else:
+            operation = '%sObject' % method.title()
+        self.count(operation)
+
+        roll = random.random()
+        if roll < self.throttle_rate:
+            self.count('throttled')
+            return self.error(start_response, '503 Slow Down', 'SlowDown', method)
+        if roll < self.throttle_rate + self.error_rate:
+            self.count('errored')
+            return self.error(start_response, '500 Internal Server Error', 'InternalError', method)
+
+        if operation == 'ListObjectsV2':
+            return self.list_objects(start_response, bucket, query)
+
+        body = self.objects.get(key)
+        if body is None:
+            return self.error(start_response, '404 Not Found', 'NoSuchKey', method)
+
+        headers = [('ETag', '"0"'), ('Last-Modified', 'Mon, 20 Mar 2017 00:00:00 GMT')]
+        if method == 'HEAD':
+            start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+            return [b'']
+        return self.respond(start_response, '200 OK', body, headers)
+
+    def list_objects(self, start_response, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        after = query.get('continuation-token', query.get('start-after', ['']))[0]
+
+        start = bisect.bisect_right(self.sorted_keys, after) if after else 0
+        start = max(start, bisect.bisect_left(self.sorted_keys, prefix))
+
+        keys = []
+        truncated = False
+        for key in self.sorted_keys[start:]:
+            if not key.startswith(prefix):
+                break
+            if len(keys) == max_keys:
+                truncated = True
+                break
+            keys.append(key)
+
+        body = LIST_XML.format(
+            bucket=escape(bucket),
+            prefix=escape(prefix),
+            count=len(keys),
+            max_keys=max_keys,
+            truncated='true' if truncated else 'false',
+            contents=''.join(
+                CONTENTS_XML.format(key=escape(key), size=len(self.objects[key]))
+                for key in keys
+            ),
+            token=(
+                '<NextContinuationToken>%s</NextContinuationToken>' % escape(keys[-1])
+                if truncated else ''
+            ),
+        ).encode('utf-8')
+        return self.respond(
+            start_response, '200 OK', body, [('Content-Type', 'application/xml')]
+        )
@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Startup-time benchmark for the tools
+
+This times importing each tool module and running each tool with ``--help``
+in a fresh interpreter, which is what the many short invocations in scripts
+pay every time. It also checks that importing a module doesn't have side
+effects like creating log files or gevent monkeypatching.
+
+Usage::
+
+    python benchmarks/startup.py [--runs N] [--max-ms MS]
+
+
+With ``--max-ms``, it exits with 1 if any median is over that many
+milliseconds.
+
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    'antenna_debug_utils.faux_processor',
+    'antenna_debug_utils.log_parser',
+    'antenna_debug_utils.verify_crashids',
+]
+
+# Prints something if importing the module did something it shouldn't have
+SIDE_EFFECTS_CHECK = """
+import os, sys
+import {module}
+problems = []
+if os.listdir('.'):
+    problems.append('created files: %s' % ', '.join(os.listdir('.')))
+for heavy in ('boto3', 'botocore', 'pika'):
+    if heavy in sys.modules:
+        problems.append('imported %s' % heavy)
+if 'gevent.monkey' in sys.modules:
+    from gevent import monkey
+    if monkey.is_anything_patched():
+        problems.append('gevent monkeypatched')
+print('; '.join(problems))
+"""
+
+
+def run_python(code_or_args, cwd):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    if isinstance(code_or_args, str):
+        cmd = [sys.executable, '-c', code_or_args]
+    else:
+        cmd = [sys.executable] + code_or_args
+
+    start = time.perf_counter()
+    proc = subprocess.run(
+        cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    elapsed = time.perf_counter() - start
+    return elapsed, proc
+
+
+def time_command(code_or_args, runs):
+    """Returns the median wall time in ms over ``runs`` fresh interpreters"""
+    times = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as cwd:
+            elapsed, proc = run_python(code_or_args, cwd)
+            if proc.returncode != 0:
+                raise RuntimeError(
+                    '%s failed:\n%s' % (code_or_args, proc.stderr.decode('utf-8'))
+                )
+            times.append(elapsed * 1000)
+    return statistics.median(times)
+
+
+def check_side_effects(module):
+    with tempfile.TemporaryDirectory() as cwd:
+        _, proc = run_python(SIDE_EFFECTS_CHECK.format(module=module), cwd)
+        if proc.returncode != 0:
+            return 'import failed: %s' % proc.stderr.decode('utf-8').strip()
+        return proc.stdout.decode('utf-8').strip()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Startup-time benchmark for the tools')
+    parser.add_argument('--runs', type=int, default=10, help='runs per measurement')
+    parser.add_argument(
+        '--max-ms', type=float, default=None,
+        help='exit with 1 if any median is over this many milliseconds'
+    )
+    args = parser.parse_args(args)
+
+    baseline = time_command('pass', args.runs)
+    print('python startup: %7.1fms' % baseline)
+    print()
+
+    over = []
+    problems = []
+    print('%-40s  %10s  %10s' % ('module', 'import', '--help'))
+    for module in MODULES:
+        import_ms = time_command('import %s' % module, args.runs)
+        help_ms = time_command(['-m', module, '--help'], args.runs)
+        print('%-40s  %8.1fms  %8.1fms' % (module, import_ms, help_ms))
+
+        if args.max_ms is not None and max(import_ms, help_ms) > args.max_ms:
+            over.append(module)
+
+        side_effects = check_side_effects(module)
+        if side_effects:
+            problems.append('%s: %s' % (module, side_effects))
+
+    print()
+    for problem in problems:
+        print('SIDE EFFECT: %s' % problem)
+    for module in over:
+        print('TOO SLOW: %s is over %sms' % (module, args.max_ms))
+
+    if over or problems:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
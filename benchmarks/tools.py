@@ -0,0 +1,271 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Throughput benchmarks for faux-processor and verify-crashids
+
+This runs scripted scenarios against the in-process RabbitMQ and S3
+stand-ins in ``fakes.py``, so it needs no brokers, buckets or network. For
+each scenario, it reports items/sec, S3 requests/sec, HEAD/sec and p50/p99
+latency.
+
+For faux-processor, latency is the time to handle one message: pulling it,
+HEADing it and acking it. For verify-crashids, latency is S3 request latency
+as verify-crashids measured it.
+
+Usage::
+
+    python benchmarks/tools.py [--tool TOOL] [--scenario NAME] [--json FILE]
+
+"""
+
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# This has to happen before anything imports boto3
+from antenna_debug_utils import verify_crashids  # noqa
+verify_crashids.monkeypatch()
+
+import argparse  # noqa
+import contextlib  # noqa
+import io  # noqa
+import json  # noqa
+import logging  # noqa
+import random  # noqa
+import tempfile  # noqa
+import time  # noqa
+import uuid  # noqa
+
+from everett.manager import ConfigDictEnv, ConfigManager  # noqa
+
+from antenna_debug_utils import faux_processor  # noqa
+from fakes import FakeChannel, FakeS3Server  # noqa
+
+
+BUCKET = 'benchmark-bucket'
+REGION = 'us-east-1'
+
+FAUX_PROCESSOR = 'faux-processor'
+VERIFY_CRASHIDS = 'verify-crashids'
+
+# Defaults for scenario settings
+DEFAULTS = {
+    'count': 2000,
+    # Fraction of crash ids that are in the bucket
+    'present': 0.95,
+    # Number of distinct {entropy} values crash ids are spread over
+    'entropies': 4096,
+    # Number of other crashes in the bucket
+    'extra_keys': 0,
+    'latency': 0.005,
+    'jitter': 0.0,
+    'error_rate': 0.0,
+    'throttle_rate': 0.0,
+    'args': [],
+}
+
+SCENARIOS = [
+    {'name': 'baseline', 'tool': FAUX_PROCESSOR, 'count': 500},
+    {'name': 'slow-s3', 'tool': FAUX_PROCESSOR, 'count': 200, 'latency': 0.03, 'jitter': 0.02},
+    {'name': 'flaky-s3', 'tool': FAUX_PROCESSOR, 'count': 500, 'error_rate': 0.02,
+     'throttle_rate': 0.05},
+
+    {'name': 'baseline', 'tool': VERIFY_CRASHIDS},
+    {'name': 'slow-s3', 'tool': VERIFY_CRASHIDS, 'latency': 0.03, 'jitter': 0.02},
+    {'name': 'throttled', 'tool': VERIFY_CRASHIDS, 'throttle_rate': 0.1,
+     'args': ['--max-concurrency=50']},
+    {'name': 'flaky-s3', 'tool': VERIFY_CRASHIDS, 'error_rate': 0.02, 'throttle_rate': 0.02},
+    {'name': 'list-strategy', 'tool': VERIFY_CRASHIDS, 'count': 5000, 'entropies': 16,
+     'extra_keys': 5000, 'args': ['--strategy=list']},
+    {'name': 'all-artifacts', 'tool': VERIFY_CRASHIDS, 'args': ['--artifacts=all']},
+]
+
+
+def make_crashid(entropy):
+    # Use random so --seed makes runs repeatable
+    crashid = str(uuid.UUID(int=random.getrandbits(128), version=4))
+    return '%03x%s0170320' % (entropy, crashid[3:-7])
+
+
+def build_bucket(settings):
+    """Builds crash ids and the objects in the bucket for a scenario
+
+    :returns: ``(crashids, objects)``
+
+    """
+    all_artifacts = '--artifacts=all' in settings['args']
+
+    crashids = [
+        make_crashid(random.randrange(settings['entropies']))
+        for _ in range(settings['count'])
+    ]
+    present = crashids[:int(len(crashids) * settings['present'])]
+    others = [
+        make_crashid(random.randrange(settings['entropies']))
+        for _ in range(settings['extra_keys'])
+    ]
+
+    objects = {}
+    for crashid in present + others:
+        objects[verify_crashids.crashid_to_key(crashid)] = b'{}'
+        if all_artifacts:
+            objects[verify_crashids.crashid_to_dump_names_key(crashid)] = (
+                b'["upload_file_minidump"]'
+            )
+            objects[verify_crashids.crashid_to_dump_key(crashid, None)] = b'dump'
+
+    random.shuffle(crashids)
+    return crashids, objects
+
+
+def start_server(settings, objects):
+    return FakeS3Server(
+        objects=objects,
+        latency=settings['latency'],
+        jitter=settings['jitter'],
+        error_rate=settings['error_rate'],
+        throttle_rate=settings['throttle_rate'],
+    ).start()
+
+
+def run_faux_processor(settings):
+    crashids, objects = build_bucket(settings)
+    server = start_server(settings, objects)
+
+    # Build the client the way faux-processor does so it picks up the
+    # defaults for everything not set here
+    config = ConfigManager([
+        ConfigDictEnv({
+            'S3_ACCESS_KEY': 'fake',
+            'S3_SECRET_ACCESS_KEY': 'fake',
+            'S3_REGION': REGION,
+            'S3_BUCKET': BUCKET,
+            'S3_ENDPOINT_URL': server.endpoint_url,
+        })
+    ]).with_options(faux_processor.ProcessorProgram)
+    conn = faux_processor.get_conn(config)
+    channel = FakeChannel([crashid.encode('utf-8') for crashid in crashids])
+
+    start = time.perf_counter()
+    faux_processor.check_for_crashes(channel, 'queue', conn, BUCKET)
+    elapsed = time.perf_counter() - start
+    server.stop()
+
+    times = channel.get_times
+    latencies = sorted(b - a for a, b in zip(times, times[1:]))
+    return {
+        'items': channel.acked,
+        'elapsed': elapsed,
+        'requests': server.requests,
+        'p50_ms': verify_crashids.percentile(latencies, 50) * 1000,
+        'p99_ms': verify_crashids.percentile(latencies, 99) * 1000,
+    }
+
+
+def run_verify_crashids(settings):
+    crashids, objects = build_bucket(settings)
+    server = start_server(settings, objects)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ids_file = os.path.join(tmpdir, 'crashids.txt')
+        summary_file = os.path.join(tmpdir, 'summary.json')
+        with open(ids_file, 'w') as fp:
+            fp.write('\n'.join(crashids) + '\n')
+
+        args = [
+            '--bucket=%s' % BUCKET,
+            '--region=%s' % REGION,
+            '--access-key=fake',
+            '--secret-access-key=fake',
+            '--endpoint-url=%s' % server.endpoint_url,
+            '--summary-file=%s' % summary_file,
+        ] + settings['args'] + [ids_file]
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            verify_crashids.main(args)
+        elapsed = time.perf_counter() - start
+
+        with open(summary_file, 'r') as fp:
+            summary = json.load(fp)
+
+    server.stop()
+    return {
+        'items': summary['total'],
+        'elapsed': elapsed,
+        'requests': server.requests,
+        'p50_ms': summary['latency_ms']['p50'],
+        'p99_ms': summary['latency_ms']['p99'],
+    }
+
+
+# S3 operations the fake counts; it also counts throttled and errored
+OPERATIONS = ('HeadObject', 'GetObject', 'ListObjectsV2')
+
+RUNNERS = {
+    FAUX_PROCESSOR: run_faux_processor,
+    VERIFY_CRASHIDS: run_verify_crashids,
+}
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Throughput benchmarks for faux-processor and verify-crashids'
+    )
+    parser.add_argument('--tool', choices=sorted(RUNNERS), help='only run this tool')
+    parser.add_argument('--scenario', help='only run scenarios with this name')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--json', help='file to write results to as JSON')
+    args = parser.parse_args(args)
+
+    random.seed(args.seed)
+
+    # faux-processor logs every crash id
+    logging.getLogger('processor').setLevel(logging.CRITICAL)
+
+    print('%-16s  %-14s  %6s  %8s  %9s  %9s  %9s  %8s  %8s' % (
+        'tool', 'scenario', 'items', 'elapsed', 'items/s', 'req/s', 'HEAD/s', 'p50', 'p99'
+    ))
+
+    results = []
+    for scenario in SCENARIOS:
+        if args.tool and scenario['tool'] != args.tool:
+            continue
+        if args.scenario and scenario['name'] != args.scenario:
+            continue
+
+        settings = dict(DEFAULTS)
+        settings.update(scenario)
+
+        result = RUNNERS[scenario['tool']](settings)
+        result['tool'] = scenario['tool']
+        result['scenario'] = scenario['name']
+        results.append(result)
+
+        elapsed = result['elapsed']
+        requests = sum(
+            count for operation, count in result['requests'].items()
+            if operation in OPERATIONS
+        )
+        print('%-16s  %-14s  %6d  %7.2fs  %9.1f  %9.1f  %9.1f  %6.1fms  %6.1fms' % (
+            result['tool'],
+            result['scenario'],
+            result['items'],
+            elapsed,
+            result['items'] / elapsed,
+            requests / elapsed,
+            result['requests'].get('HeadObject', 0) / elapsed,
+            result['p50_ms'],
+            result['p99_ms'],
+        ))
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
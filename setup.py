@@ -31,7 +31,8 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
-        'boto3',
+        'boto3>=1.24.84',
+        'botocore>=1.27.84',
         'everett>=0.8',
         'pika',
     ],